@@ -2,12 +2,29 @@
 Create masks for grids using shapefiles
 """
 
-import fiona
+import hashlib
+import os
+import pickle
+
 import numpy as np
+import pyogrio.raw
+import scipy
 from scipy.spatial import cKDTree
-from shapely.geometry import MultiPolygon, Polygon, shape
+import shapely
+from shapely import GeometryType
 from skimage import draw
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+try:
+    from pykdtree.kdtree import KDTree
+except ImportError:
+    KDTree = None
+
 __all__ = ['Mask']
 
 __author__ = 'Nathan Wendt'
@@ -18,9 +35,97 @@ __email__ = 'nawendt@ou.edu'
 __status__ = 'Development'
 
 
+def _fill_polygon(rows, cols, mask):
+    """
+    Fill a polygon into the mask in place, one row of the grid at a time.
+
+    This is a scanline form of the crossing test in ``skimage.draw.polygon``, so the
+    same cells are filled, including those on the polygon boundary.
+
+    Parameters
+    ----------
+    rows: array_like
+        row indices of polygon exterior
+    cols: array_like
+        column indices of polygon exterior
+    mask: array_like
+        mask to update
+    """
+    n = rows.shape[0]
+    upward = np.empty(n)
+    downward = np.empty(n)
+
+    for r in range(rows.min(), rows.max() + 1):
+        # Columns where each edge crosses this row, split by crossing direction
+        nup = 0
+        ndown = 0
+        j = n - 1
+        for i in range(n):
+            ri = rows[i] - r
+            rj = rows[j] - r
+            up = (ri > 0) != (rj > 0)
+            down = (ri < 0) != (rj < 0)
+            if up or down:
+                crossing = (cols[i] * rj - cols[j] * ri) / (rj - ri)
+                if up:
+                    upward[nup] = crossing
+                    nup += 1
+                if down:
+                    downward[ndown] = crossing
+                    ndown += 1
+            j = i
+
+        upward[:nup].sort()
+        downward[:ndown].sort()
+
+        # Cells with an odd number of crossings on either side are inside or on an edge
+        iup = 0
+        idown = 0
+        for c in range(cols.min(), cols.max() + 1):
+            while iup < nup and upward[iup] <= c:
+                iup += 1
+            while idown < ndown and downward[idown] < c:
+                idown += 1
+            if (nup - iup) % 2 or idown % 2:
+                mask[r, c] = 1
+
+    # Vertices are always part of the polygon
+    for i in range(n):
+        mask[rows[i], cols[i]] = 1
+
+
+def _fill_polygons(rows, cols, offsets, mask):
+    """
+    Fill many polygons into the mask in place, in parallel when compiled with Numba.
+    Every write sets a cell to 1, so overlapping polygons can be filled concurrently.
+
+    Parameters
+    ----------
+    rows: array_like
+        row indices of all polygon exteriors
+    cols: array_like
+        column indices of all polygon exteriors
+    offsets: array_like
+        start of each polygon exterior in ``rows`` and ``cols``, followed by the end of
+        the last one
+    mask: array_like
+        mask to update
+    """
+    for k in prange(offsets.shape[0] - 1):
+        start = offsets[k]
+        end = offsets[k + 1]
+        if end > start:
+            _fill_polygon(rows[start:end], cols[start:end], mask)
+
+
+if njit is not None:
+    _fill_polygon = njit(cache=True)(_fill_polygon)
+    _fill_polygons = njit(cache=True, parallel=True)(_fill_polygons)
+
+
 class Mask(object):
 
-    def __init__(self, x, y, shapefile, dx=np.inf, centered=True):
+    def __init__(self, x, y, shapefile, dx=np.inf, centered=True, cache_dir=None):
         """
         Create a ``Mask`` instance from which you can grid a shapefile and use it as a
         mask for a field.
@@ -38,117 +143,456 @@ class Mask(object):
             will help performance.
         centered: bool
             Flag for whether the coordinates are at the grid center. Default is True.
+        cache_dir: str
+            Directory in which to keep the KDTree for a grid between runs, e.g.
+            ``~/.maskmaker/cache``. Default is None, which disables caching. Only use a
+            directory you trust, since cached trees are loaded with pickle.
         """
 
-        self.x = x
-        self.y = y
-        self.shapefile = fiona.open(shapefile)
+        # Keep the grid C-ordered so flattening it never needs a copy
+        self.x = np.ascontiguousarray(x)
+        self.y = np.ascontiguousarray(y)
+        self.shapefile = shapefile
         self.dx = dx
         self.centered = centered
+        self.cache_dir = cache_dir
         self.mask = None
+        self.tree = None
+        self._points = None
+        self._cache_file = None
+        self._regular = self._check_regular()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.shapefile.closed:
-            self.shapefile.close()
+    def _read_shapefile(self):
+        """
+        Read the geometries of the shapefile.
 
-    def _make_tree(self):
+        Returns
+        -------
+        geoms: array_like
+            Geometry of each feature
+        """
+        # Read every geometry in bulk as WKB, skipping the attributes
+        return shapely.from_wkb(pyogrio.raw.read(self.shapefile, columns=[])[2])
+
+    def _check_regular(self):
+        """
+        Check whether the grid is regular, i.e. x varies only along columns and y only
+        along rows, each with uniform spacing. If so, store what is needed to map
+        coordinates to grid indices arithmetically instead of with a KDTree.
+
+        Returns
+        -------
+        regular: bool
+            True if the grid is regular.
+        """
+        x = self.x
+        y = self.y
+        if x.ndim != 2 or x.shape != y.shape or min(x.shape) < 2:
+            return False
+
+        ny, nx = x.shape
+        x0 = x[0, 0]
+        y0 = y[0, 0]
+        xstep = (x[0, -1] - x0) / (nx - 1)
+        ystep = (y[-1, 0] - y0) / (ny - 1)
+        if not (np.isfinite(xstep) and np.isfinite(ystep)) or xstep == 0 or ystep == 0:
+            return False
+
+        # Allow a small fraction of a grid cell of error in each coordinate
+        if not np.allclose(x, x0 + xstep * np.arange(nx), rtol=0,
+                           atol=1e-3 * abs(xstep)):
+            return False
+        if not np.allclose(y, (y0 + ystep * np.arange(ny))[:, None], rtol=0,
+                           atol=1e-3 * abs(ystep)):
+            return False
+
+        if not self.centered:
+            x0 += xstep / 2.
+            y0 += ystep / 2.
+
+        self._x0 = x0
+        self._y0 = y0
+        self._xstep = xstep
+        self._ystep = ystep
+        self._nx = nx
+        self._ny = ny
+
+        return True
+
+    def _grid_indices(self, px, py):
         """
-        Create KDTree.
+        Find the nearest grid cell to each point on a regular grid.
+
+        Parameters
+        ----------
+        px: array_like
+            x coordinates of points
+        py: array_like
+            y coordinates of points
+
+        Returns
+        -------
+        inds: array_like
+            flattened indices of the nearest grid cells. As with the KDTree, points
+            farther than ``dx`` from the grid are given the size of the grid.
         """
+        fx = (np.asarray(px) - self._x0) / self._xstep
+        fy = (np.asarray(py) - self._y0) / self._ystep
+        # Round halves up rather than to even, so points exactly on a cell edge always
+        # go to the same side of it
+        ix = np.clip(np.floor(fx + 0.5), 0, self._nx - 1)
+        iy = np.clip(np.floor(fy + 0.5), 0, self._ny - 1)
+
+        inds = (iy * self._nx + ix).astype(np.intp)
+        dist = np.hypot((fx - ix) * self._xstep, (fy - iy) * self._ystep)
+        inds[dist >= self.dx] = self._nx * self._ny
+
+        return inds
 
-        tx = np.array(self.x, copy=True, subok=True)
-        ty = np.array(self.y, copy=True, subok=True)
+    def _grid_points(self):
+        """
+        Get the grid points to search for the nearest grid cell.
+
+        Returns
+        -------
+        points: array_like
+            (N, 2) array of grid point coordinates
+        bound: float
+            largest distance from a point within the grid to its nearest grid point
+        """
+        tx = self.x
+        ty = self.y
         if not self.centered:
-            x = tx.copy()
-            y = ty.copy()
-            x[:, :-1] = tx[:, :-1] + (tx[:, 1:] - tx[:, :-1]) / 2.
-            x[:, -1] += (tx[:, -1] - tx[:, -2]) / 2.
-            y[:-1, :] = ty[:-1, :] + (ty[1:, :] - ty[:-1, :]) / 2.
-            y[-1, :] += (ty[-1, :] - ty[-2, :]) / 2.
-            tx = x
-            ty = y
-            del x
-            del y
-        tpoints = np.asarray(list(zip(tx.ravel(), ty.ravel())))
+            # Shift to the cell centers, reusing the last half step at the far edges
+            dxh = np.diff(tx, axis=1) * 0.5
+            cx = np.empty_like(tx)
+            cx[:, :-1] = tx[:, :-1] + dxh
+            cx[:, -1] = tx[:, -1] + dxh[:, -1]
+            dyh = np.diff(ty, axis=0) * 0.5
+            cy = np.empty_like(ty)
+            cy[:-1, :] = ty[:-1, :] + dyh
+            cy[-1, :] = ty[-1, :] + dyh[-1, :]
+            tx = cx
+            ty = cy
+        # Polygon vertices are always float64, and pykdtree needs the tree to match
+        tpoints = np.column_stack((tx.ravel(order='C'), ty.ravel(order='C')))
+        tpoints = tpoints.astype(np.float64, copy=False)
+
+        # No point within the grid is farther from its nearest grid point than the
+        # largest cell diagonal, so use that to bound the search and prune the tree
+        xstep = np.nanmax(np.hypot(np.diff(tx, axis=1), np.diff(ty, axis=1)), initial=0)
+        ystep = np.nanmax(np.hypot(np.diff(tx, axis=0), np.diff(ty, axis=0)), initial=0)
 
+        return tpoints, xstep + ystep
+
+    @staticmethod
+    def _build_tree(points):
+        """
+        Create KDTree over the given points.
+        """
+        if KDTree is not None:
+            return KDTree(points, leafsize=16)
+
+        return cKDTree(points)
+
+    def _make_tree(self):
+        """
+        Create KDTree over the whole grid, saving it to the cache if there is one.
+        """
+        if self._points is None:
+            self._points, self._bound = self._grid_points()
+        tpoints = self._points
+        # The tree holds the grid points from here on
+        self._points = None
+
+        path = self._cache_path()
+        if path is None:
+            self.tree = self._build_tree(tpoints)
+            return
+
+        # pykdtree trees cannot be pickled, so always cache a SciPy tree
         self.tree = cKDTree(tpoints)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((self.tree, self._bound), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
 
-    def make(self):
+    def _load_tree(self):
+        """
+        Load the KDTree for this grid from the cache, if it is there.
+        """
+        path = self._cache_path()
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.tree, self._bound = pickle.load(f)
+
+    def _cache_path(self):
+        """
+        Get the cache file for the KDTree of this grid.
+
+        Returns
+        -------
+        path: str or None
+            Path to the cache file, or None if caching is disabled.
+        """
+        if self.cache_dir is None:
+            return None
+        if self._cache_file is not None:
+            return self._cache_file
+
+        key = hashlib.blake2b(digest_size=16)
+        for item in (__version__, scipy.__version__, self.centered, self.x.dtype.str,
+                     self.x.shape, self.y.dtype.str, self.y.shape):
+            key.update(repr(item).encode())
+        key.update(self.x.tobytes())
+        key.update(self.y.tobytes())
+
+        self._cache_file = os.path.join(os.path.expanduser(self.cache_dir),
+                                        '{}.pkl'.format(key.hexdigest()))
+
+        return self._cache_file
+
+    def _query_tree(self, points):
+        """
+        Find the grid point nearest to each point using a KDTree.
+
+        Parameters
+        ----------
+        points: array_like
+            (N, 2) array of point coordinates
+
+        Returns
+        -------
+        inds: array_like
+            flattened indices of the nearest grid points. Points farther than ``dx``
+            from the grid are given the size of the grid.
+        """
+        inds = None
+        if self.tree is None and self._points is None:
+            # First query on this grid. Use the cached tree if there is one, and
+            # otherwise try a tree over just the nearby part of the grid. A later query,
+            # or caching, makes a full tree worth building.
+            self._load_tree()
+            if self.tree is None:
+                self._points, self._bound = self._grid_points()
+                if self.cache_dir is None:
+                    inds = self._query_near(self._points, points,
+                                            min(self.dx, self._bound))
+
+        bound = min(self.dx, self._bound)
+        if inds is None:
+            if self.tree is None:
+                self._make_tree()
+            inds = self._nearest(self.tree, points, bound)
+
+        if self.dx > bound:
+            # Points off the grid may still be within dx of it, so search further
+            far = inds == self.x.size
+            if far.any():
+                if self.tree is None:
+                    self._make_tree()
+                inds[far] = self._nearest(self.tree, points[far], self.dx)
+
+        return inds
+
+    def _query_near(self, tpoints, points, bound):
+        """
+        Find the grid point nearest to each point using a KDTree over only the grid
+        points within ``bound`` of the bounding box of the points. Any grid point within
+        ``bound`` of a point is in that subset, so the result is the same as searching
+        the whole grid. This is only done when the subset is small.
+
+        Parameters
+        ----------
+        tpoints: array_like
+            (N, 2) array of grid point coordinates
+        points: array_like
+            (M, 2) array of point coordinates
+        bound: float
+            Maximum search distance
+
+        Returns
+        -------
+        inds: array_like or None
+            flattened indices of the nearest grid points, with the size of the grid for
+            points farther than ``bound``. None if the subset is too large to be worth
+            it.
+        """
+        lower = points.min(axis=0) - bound
+        upper = points.max(axis=0) + bound
+        near = np.flatnonzero(np.all((tpoints >= lower) & (tpoints <= upper), axis=1))
+        if near.size > tpoints.shape[0] // 4:
+            return None
+
+        inds = np.full(points.shape[0], self.x.size, dtype=np.intp)
+        if near.size:
+            sub = self._nearest(self._build_tree(tpoints[near]), points, bound)
+            found = sub < near.size
+            inds[found] = near[sub[found]]
+
+        return inds
+
+    @staticmethod
+    def _nearest(tree, points, bound):
+        """
+        Query a KDTree for the nearest point within ``bound`` of each point.
+        """
+        if isinstance(tree, cKDTree):
+            _, inds = tree.query(points, k=1, distance_upper_bound=bound, workers=-1)
+        else:
+            # pykdtree spreads queries over cores with OpenMP on its own
+            _, inds = tree.query(points, k=1, distance_upper_bound=bound)
+
+        return inds
+
+    def make(self, shapefile=None):
         """
         Create a mask within given grid based on given shapefile.
+
+        Anything derived from the grid, such as the KDTree, is kept between calls, so
+        ``x``, ``y`` and ``centered`` must not be changed after the first call. Create a
+        new ``Mask`` for a different grid.
+
+        Parameters
+        ----------
+        shapefile: str
+            Path to a different shapefile to mask on the same grid. Default is None,
+            which uses the current shapefile.
         """
 
-        self._make_tree()
-        self.mask = np.zeros(self.x.shape)
+        if shapefile is not None:
+            self.shapefile = shapefile
 
-        # Get coordinates from shapefile for each polygon
-        for shp in self.shapefile:
-            poly = shape(shp['geometry'])
+        self.mask = np.zeros(self.x.shape, dtype=np.uint8)
 
-            if isinstance(poly, Polygon):
-                xx, yy, coords = self._gridify(poly)
-                self._update_mask(xx, yy, coords)
-            elif isinstance(poly, MultiPolygon):
-                # Loop over each piece of the polygon and add it to mask
-                for part in poly:
-                    xx, yy, coords = self._gridify(part)
-                    self._update_mask(xx, yy, coords)
-            else:
-                raise TypeError('Unknown shape type {}'.format(type(poly).__name__))
+        # Get each polygon from the shapefile. Nothing read is kept after this call.
+        geoms = self._read_shapefile()
+        types = shapely.get_type_id(geoms)
+        unknown = ~np.isin(types, (GeometryType.POLYGON, GeometryType.MULTIPOLYGON))
+        if unknown.any():
+            poly = geoms[unknown][0]
+            raise TypeError('Unknown shape type {}'.format(type(poly).__name__))
 
-        # Make sure double-counted points are handled
-        self.mask[self.mask > 1] = 1
+        # Each piece of a MultiPolygon is added to mask separately
+        polygons = shapely.get_parts(geoms)
+        if self._regular:
+            polygons = self._fill_rectangles(polygons)
 
-    def _gridify(self, polygon):
+        rows, cols, offsets = self._exterior_indices(polygons)
+        if njit is not None:
+            _fill_polygons(rows, cols, offsets, self.mask)
+        else:
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                self._update_mask(rows[start:end], cols[start:end])
+
+    def _fill_rectangles(self, polygons):
         """
-        Grid a polygon using a KDTree.
+        Fill axis-aligned rectangles into the mask in place. On a regular grid their
+        corners map to a block of whole rows and columns, which is filled directly.
 
         Parameters
         ----------
-        polygon: Polygon or MultiPolygon
-            Polygon to grid
+        polygons: array_like
+            Polygons to grid
 
         Returns
         -------
-        x: array_like
-            x coordinates of filled polygon
-        y: array_like
-            y coordinates of filled polygon
-        coords: list of arrays
-            coordinate arrays of polygon exterior
-        """
-        px, py = polygon.exterior.xy
-        try:
-            points = np.asarray(list(zip(px, py)))
-        except TypeError:
-            points = np.asarray(list(zip([px], [py])))
-        _, inds = self.tree.query(points, k=1, distance_upper_bound=self.dx)
-        # Remove points outside the destination grid
-        bad_inds = np.where(inds >= len(self.tree.data))[0]
-        inds = np.delete(inds, bad_inds)
+        polygons: array_like
+            Polygons that still need to be gridified
+        """
+        rects = ~shapely.is_empty(polygons)
+        candidates = polygons[rects]
+        rects[rects] = shapely.equals(candidates, shapely.envelope(candidates))
+        if not rects.any():
+            return polygons
 
-        coords = np.unravel_index(inds, self.x.shape)
-        x, y = draw.polygon(*coords)
+        minx, miny, maxx, maxy = shapely.bounds(polygons[rects]).T
+        corners = self._grid_indices(np.column_stack((minx, maxx, maxx, minx)),
+                                     np.column_stack((miny, miny, maxy, maxy)))
+        rows, cols = np.divmod(corners, self._nx)
+        r0 = rows.min(axis=1)
+        r1 = rows.max(axis=1)
+        c0 = cols.min(axis=1)
+        c1 = cols.max(axis=1)
 
-        return x, y, coords
+        # Rectangles with a corner beyond dx, or squashed into a single row or column,
+        # are left to the general path
+        filled = np.all(corners < self.x.size, axis=1) & (r0 < r1) & (c0 < c1)
+        for i in np.flatnonzero(filled):
+            self.mask[r0[i]:r1[i] + 1, c0[i]:c1[i] + 1] = 1
 
-    def _update_mask(self, x, y, coords):
+        rects[rects] = filled
+        return polygons[~rects]
+
+    def _exterior_indices(self, polygons):
         """
-        Update the mask at point(s) (x, y) in place.
+        Find the grid cells nearest to the exterior of each polygon. The vertices of all
+        polygons are looked up together in a single KDTree query.
 
-        x: array_like
-            x coordinates of filled polygon
-        y: array_like
-            y coordinates of filled polygon
-        coords: list of arrays
-            coordinate arrays of polygon exterior
-        """
-        if not x.shape:
-            # Handle situation where a polygon cannot be drawn.
-            # This will be more likely when the destination grid
-            # is coarse enough that small islands get placed in the
-            # same grid cell, or similar situation.
-            for pt in zip(*coords):
-                self.mask[pt] += 1
+        Parameters
+        ----------
+        polygons: array_like
+            Polygons to grid
+
+        Returns
+        -------
+        rows: array_like
+            row indices of all polygon exteriors
+        cols: array_like
+            column indices of all polygon exteriors
+        offsets: array_like
+            start of each polygon exterior in ``rows`` and ``cols``, followed by the end
+            of the last one
+        """
+        # All exterior vertices, and the polygon each belongs to
+        rings = shapely.get_exterior_ring(polygons)
+        points, owner = shapely.get_coordinates(rings, return_index=True)
+
+        if self._regular:
+            inds = self._grid_indices(points[:, 0], points[:, 1])
+        elif points.size:
+            inds = self._query_tree(points)
         else:
-            self.mask[x, y] += 1
+            inds = np.empty(0, dtype=np.intp)
+
+        # Remove points outside the destination grid
+        keep = inds < self.x.size
+        inds = inds[keep]
+        owner = owner[keep]
+
+        # Remove vertices in the same cell as the one before, since they only add
+        # zero-length edges that do not change the filled polygon
+        keep = np.ones(inds.shape, dtype=bool)
+        keep[1:] = (inds[1:] != inds[:-1]) | (owner[1:] != owner[:-1])
+        inds = inds[keep]
+        owner = owner[keep]
+
+        rows, cols = np.unravel_index(inds, self.x.shape)
+        offsets = np.zeros(len(polygons) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(owner, minlength=len(polygons)), out=offsets[1:])
+
+        return rows, cols, offsets
+
+    def _update_mask(self, rows, cols):
+        """
+        Fill a polygon into the mask in place.
+
+        Parameters
+        ----------
+        rows: array_like
+            row indices of polygon exterior
+        cols: array_like
+            column indices of polygon exterior
+        """
+        if not rows.size:
+            # The whole polygon is beyond the search distance of the grid
+            return
+
+        # Rasterize within the bounding box of the polygon only. Overlapping polygons
+        # are combined with a logical or so no cell is ever double-counted.
+        r0, r1 = rows.min(), rows.max() + 1
+        c0, c1 = cols.min(), cols.max() + 1
+        local = draw.polygon2mask((r1 - r0, c1 - c0),
+                                  np.column_stack((rows - r0, cols - c0)))
+        self.mask[r0:r1, c0:c1] |= local
@@ -1,7 +1,7 @@
 from distutils.core import setup
 from maskmaker import __author__, __email__, __version__
 
-dependencies = ['fiona', 'numpy', 'scikit-image', 'scipy', 'shapely']
+dependencies = ['numpy', 'pyogrio', 'scikit-image', 'scipy>=1.6', 'shapely>=2']
 
 setup(
     name='maskmaker',
@@ -12,5 +12,6 @@ setup(
     author_email=__email__,
     author=__author__,
     description='Create masks for grids using shapefiles',
-    install_requires=dependencies
+    install_requires=dependencies,
+    extras_require={'numba': ['numba'], 'pykdtree': ['pykdtree']}
 )